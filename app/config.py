@@ -0,0 +1,47 @@
+# app/config.py
+
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Настройки приложения из переменных окружения."""
+
+    telegram_bot_token: str
+    webhook_secret: str
+    public_url: str
+    supabase_url: str
+    supabase_key: str
+    # DEBUG=1 — включает диагностические зонды _probe в цепочке хэндлеров
+    debug: bool
+    # как часто PTB сбрасывает изменения user/chat/bot_data в persistence (сек)
+    persistence_update_interval: float
+    # сколько воркеров обрабатывают апдейты одновременно (см. _update_worker в main.py)
+    concurrent_updates: int
+    # предел очереди апдейтов: при переполнении отвечаем 503, Telegram повторит позже
+    update_queue_size: int
+    # сколько ждать при остановке, пока воркеры доработают очередь апдейтов (сек)
+    shutdown_timeout: float
+    port: int
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Читает окружение один раз; дальше возвращает тот же объект."""
+    return Settings(
+        telegram_bot_token=os.getenv("TELEGRAM_BOT_TOKEN", ""),
+        webhook_secret=os.getenv("WEBHOOK_SECRET", "jslkdji&8987812kjkj9989l_lki"),
+        public_url=os.getenv("PUBLIC_URL", "").rstrip("/"),
+        supabase_url=os.getenv("SUPABASE_URL", ""),
+        supabase_key=os.getenv("SUPABASE_KEY", ""),
+        debug=os.getenv("DEBUG", "").lower() in ("1", "true", "yes"),
+        persistence_update_interval=float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "60")),
+        concurrent_updates=int(os.getenv("CONCURRENT_UPDATES", "256")),
+        update_queue_size=int(os.getenv("UPDATE_QUEUE_SIZE", "1000")),
+        shutdown_timeout=float(os.getenv("SHUTDOWN_TIMEOUT", "20")),
+        port=int(os.getenv("PORT", "8000")),
+    )
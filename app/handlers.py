@@ -1,18 +1,68 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, ApplicationHandlerStop
 from telegram.error import TelegramError, TimedOut, BadRequest, Forbidden
-from telegram.constants import ChatAction, MessageEntityType
-import logging
+from telegram.constants import MessageEntityType
 
 import asyncio
-
-from datetime import datetime, timezone
-
 import logging
+from collections import OrderedDict
+
 log = logging.getLogger("app.handlers")  # дочерний логгер
 
+_BOT_CMD = MessageEntityType.BOT_COMMAND
+_TYPING = "typing"  # ChatAction.TYPING — PTB принимает и обычную строку
+
 THROTTLE_SECONDS = 1.0  # задержка от спама, время можно менять под себя
 
+# loop.time — монотонные часы event loop; привязываем один раз при первом вызове
+_loop_time = None
+
+# Метки последних сообщений держим в памяти процесса, а не в user_data:
+# это эфемерные данные, persistence их сохранять незачем.
+# LRU с ограничением размера, чтобы словарь не рос бесконечно.
+_THROTTLE: "OrderedDict[int, float]" = OrderedDict()
+_THROTTLE_MAX = 50_000
+
+# --- Статичные тексты и клавиатуры: собираем один раз при импорте ---
+HELP_TEXT = (
+    "Команды:\n"
+    "/start — поздороваться\n"
+    "/help — чем я умею помогать\n"
+    "/settings — открыть настройки\n"
+    "Просто напишите текст — я отвечу эхом."
+)
+NON_TEXT_REPLY = "Я пока понимаю только текст и команды. Попробуй написать сообщение 🙂 или команду /help"
+UNKNOWN_CMD_REPLY = "Не знаю такую команду. Напиши /help 🙂"
+SURVEY_ASK_NAME = "Давай познакомимся! Как тебя зовут?"
+SURVEY_CANCEL_TEXT = "Опрос отменён."
+
+SETTINGS_CB_PREFIX = "settings:"
+SETTINGS_TOGGLE_SUB = SETTINGS_CB_PREFIX + "toggle_sub"
+_KB_SUB_ON = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text="✅ Подписка ВКЛ", callback_data=SETTINGS_TOGGLE_SUB)]]
+)
+_KB_SUB_OFF = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text="🔔 Включить подписку", callback_data=SETTINGS_TOGGLE_SUB)]]
+)
+
+
+# Фоновые задачи держим в множестве, чтобы их не собрал GC до завершения
+_BG_TASKS: set = set()
+
+
+def _typing_done(task: asyncio.Task) -> None:
+    _BG_TASKS.discard(task)
+    # забираем исключение, иначе asyncio ругается "Task exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        log.debug("send_action failed: %s", task.exception())
+
+
+def _send_typing(chat) -> None:
+    """Показывает "печатает..." в фоне: ответ пользователю этот запрос не ждёт."""
+    task = asyncio.create_task(chat.send_action(_TYPING))
+    _BG_TASKS.add(task)
+    task.add_done_callback(_typing_done)
+
 
 # глобальный throttle (защита от бот-сообщений)
 async def global_throttle(update, context):
@@ -21,43 +71,54 @@ async def global_throttle(update, context):
     Троттлит только обычные Message-апдейты, если они слишком частые.
     """
     # 0) Пропускаем callback_query
-    if getattr(update, "callback_query", None):
+    if update.callback_query is not None:
         return
 
-    msg = getattr(update, "effective_message", None)
-    if not msg:
+    msg = update.effective_message
+    if msg is None:
         return  # не Message-апдейт
 
     # 1) Пропускаем команды (в тексте ИЛИ в подписи)
-    entities = (msg.entities or []) + (msg.caption_entities or [])
-    if any(getattr(ent, "type", None) == MessageEntityType.BOT_COMMAND for ent in entities) \
-       or (msg.text and msg.text.startswith("/")) \
-       or (msg.caption and msg.caption.startswith("/")):
+    # сначала дешёвая проверка префикса, сущности смотрим только если нужно
+    text = msg.text or msg.caption
+    if text and text.startswith("/"):
         return
-
-    now = datetime.now(timezone.utc).timestamp()
-
-    # Вариант A: пер-пользователь (как у тебя)
-    store = context.user_data
-    # Вариант B: пер-чат (если нужно) -> store = context.chat_data
-
-    last = 0.0
-    try:
-        last = float(store.get("last_msg_ts", 0.0))
-    except Exception:
-        pass
+    ents = msg.entities
+    if ents:
+        for e in ents:
+            if e.type == _BOT_CMD:
+                return
+    ents = msg.caption_entities
+    if ents:
+        for e in ents:
+            if e.type == _BOT_CMD:
+                return
+
+    user = update.effective_user
+    if user is None:
+        return  # не от пользователя (например, пост канала)
+    user_id = user.id
+
+    global _loop_time
+    if _loop_time is None:
+        _loop_time = asyncio.get_running_loop().time
+    now = _loop_time()
+
+    last = _THROTTLE.get(user_id, 0.0)
 
     if last and (now - last) < THROTTLE_SECONDS:
         # жёстко:
         return
         # мягко: return
 
-    store["last_msg_ts"] = now
+    _THROTTLE[user_id] = now
+    _THROTTLE.move_to_end(user_id)
+    if len(_THROTTLE) > _THROTTLE_MAX:
+        _THROTTLE.popitem(last=False)  # выкидываем самого «старого» пользователя
 
 
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.debug("start(): entered")
     # счетчик запусков
     # 1) достаём старое значение (или 0, если его ещё нет)
     visits = context.user_data.get("visits", 0)
@@ -71,84 +132,81 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Привет! Я твой первый бот 🙂\n"
         f"Ты запускал команду /start уже {visits} раз(а)."
     )
-    await update.message.reply_text(text)
+    msg = update.message
+    await msg.reply_text(text)
 
 # Обработчик обычного текста (эхо)
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"Ты сказал: {update.message.text}")
+    msg = update.message
+    await msg.reply_text(f"Ты сказал: {msg.text}")
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.debug("help(): entered")
-    text = (
-        "Команды:\n"
-        "/start — поздороваться\n"
-        "/help — чем я умею помогать\n"
-        "/settings — открыть настройки\n"
-        "Просто напишите текст — я отвечу эхом."
-    )
-    await update.message.reply_text(text)
+    await update.message.reply_text(HELP_TEXT)
 
 # Обработчик диалога
 ASK_NAME = 0  # состояние диалога
 
 async def survey_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.debug("start(): entered")
-    # 🔹 Показываем "печатает..." перед отправкой вопроса
-    await update.message.chat.send_action(ChatAction.TYPING)
-    await asyncio.sleep(2)  # небольшая пауза для "естественности"
-    await update.message.reply_text("Давай познакомимся! Как тебя зовут?")
+    # 🔹 "печатает..." уходит в фоне, вопрос отправляем сразу
+    msg = update.message
+    _send_typing(msg.chat)
+    await msg.reply_text(SURVEY_ASK_NAME)
     return ASK_NAME
 
 async def survey_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_name = update.message.text
+    msg = update.message
+    user_name = msg.text
     context.user_data["name"] = user_name   # 📝 сохраняем в словарь user_data
-    await update.message.reply_text(f"Приятно познакомиться, {user_name}!")
-    return ConversationHandler.END
+    await msg.reply_text(f"Приятно познакомиться, {user_name}!")
+    # завершаем диалог и не пускаем это сообщение дальше (в echo)
+    raise ApplicationHandlerStop(ConversationHandler.END)
 
 async def survey_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Опрос отменён.")
+    await update.message.reply_text(SURVEY_CANCEL_TEXT)
     return ConversationHandler.END
 
 async def non_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # короткий ответ на любые сообщения, которые не являются текстом/командой
-    await update.message.reply_text(
-        "Я пока понимаю только текст и команды. Попробуй написать сообщение 🙂 или команду /help"
-    )
+    await update.message.reply_text(NON_TEXT_REPLY)
+
+# Один хэндлер на все НЕ-командные сообщения: вместо двух фильтров — одна проверка
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text:
+        await echo(update, context)
+    else:
+        await non_text(update, context)
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # короткая подсказка и направление к /help
-    await update.message.reply_text("Не знаю такую команду. Напиши /help 🙂")
+    await update.message.reply_text(UNKNOWN_CMD_REPLY)
     
 async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
     name = context.user_data.get("name")
     if name:
-        await update.message.reply_text(f"Ты представился как: {name}")
+        await msg.reply_text(f"Ты представился как: {name}")
     else:
-        await update.message.reply_text("Я пока не знаю, как тебя зовут. Запусти /survey 🙂")
+        await msg.reply_text("Я пока не знаю, как тебя зовут. Запусти /survey 🙂")
 
 
 
 # /settings — показать кнопки
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.chat.send_action(ChatAction.TYPING)
-    await asyncio.sleep(1.2)
     # 1) читаем текущее состояние (например, подписка)
     is_subscribed = bool(context.user_data.get("subscribed"))
 
-    # 2) собираем клавиатуру (кнопки в один ряд)
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                text="✅ Подписка ВКЛ" if is_subscribed else "🔔 Включить подписку",
-                callback_data="settings:toggle_sub"
-            ),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # 2) берём готовую клавиатуру под текущее состояние
+    reply_markup = _KB_SUB_ON if is_subscribed else _KB_SUB_OFF
 
-    # 3) отправляем сообщение с клавиатурой
-    await update.message.reply_text("Настройки:", reply_markup=reply_markup)
+    # 3) "печатает..." в фоне, сообщение с клавиатурой — сразу
+    msg = update.message
+    _send_typing(msg.chat)
+    await msg.reply_text("Настройки:", reply_markup=reply_markup)
+
+# фильтр для CallbackQueryHandler: простой префикс вместо регулярки
+def is_settings_callback(data) -> bool:
+    return isinstance(data, str) and data.startswith(SETTINGS_CB_PREFIX)
 
 # обработка нажатий на кнопки из /settings
 async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -156,32 +214,35 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # важно: подтвердить нажатие, чтобы Telegram убрал "часики"
 
     # 1) проверяем, какая кнопка нажата
-    if query.data == "settings:toggle_sub":
+    if query.data == SETTINGS_TOGGLE_SUB:
         # 2) переключаем флаг в user_data
         is_subscribed = bool(context.user_data.get("subscribed"))
         context.user_data["subscribed"] = not is_subscribed
         new_state = "включена" if context.user_data["subscribed"] else "выключена"
 
         # 3) обновляем текст сообщения и клавиатуру под новое состояние
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    text="✅ Подписка ВКЛ" if context.user_data["subscribed"] else "🔔 Включить подписку",
-                    callback_data="settings:toggle_sub"
-                ),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(
-            text=f"Настройки:\nПодписка {new_state}.",
-            reply_markup=reply_markup
-        )
+        reply_markup = _KB_SUB_ON if context.user_data["subscribed"] else _KB_SUB_OFF
+        new_text = f"Настройки:\nПодписка {new_state}."
+
+        # 4) если на экране уже то же самое — не тратим запрос к API
+        if query.message and query.message.text == new_text \
+           and query.message.reply_markup == reply_markup:
+            return
+
+        try:
+            await query.edit_message_text(text=new_text, reply_markup=reply_markup)
+        except BadRequest as e:
+            # гонка двойного клика: Telegram отвечает "message is not modified"
+            if "not modified" not in str(e).lower():
+                raise
 
 async def error_handler(update: object, context):
     try:
-        user_id = getattr(getattr(update, "effective_user", None), "id", None)
-        chat_id = getattr(getattr(update, "effective_chat", None), "id", None)
+        # update может быть не Update (например, None), поэтому getattr на верхнем уровне
+        u = getattr(update, "effective_user", None)
+        c = getattr(update, "effective_chat", None)
+        user_id = u.id if u else None
+        chat_id = c.id if c else None
         update_type = type(update).__name__ if update else "None"
 
         exc = getattr(context, "error", None)
@@ -209,6 +270,6 @@ async def error_handler(update: object, context):
 
     except Exception as e:
         # Последняя страховка — логируем, но не пробрасываем
-        logging.getLogger("app.handlers").error(
+        log.error(
             "error_handler() failed safely: %s", e, exc_info=True
         )
\ No newline at end of file
@@ -1,45 +1,65 @@
-import os
+import hmac
 import logging
-import tempfile
 import asyncio
 
+import orjson
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import (Application, CommandHandler, MessageHandler,
     filters, ConversationHandler, CallbackQueryHandler
 )
-from supabase import create_client, Client
 from app.handlers import (
-    start, echo, help_command,
+    start, route_message, help_command,
     survey_start, survey_name, survey_cancel, ASK_NAME, whoami,
-    settings_command, settings_callback, error_handler,
-    unknown_command, non_text, global_throttle
+    settings_command, settings_callback, is_settings_callback, error_handler,
+    unknown_command, global_throttle
 )
 from contextlib import asynccontextmanager
 from app.supabase_persistence import SupabasePersistence
+from app.supabase_client import close_supabase_client
+from app.config import get_settings
+
+# uvloop вместо стандартного event loop (до создания FastAPI/Application).
+# На Windows uvloop нет — тогда остаёмся на стандартном asyncio.
+# Запуск: uvicorn app.main:app --loop uvloop --http httptools
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 log = logging.getLogger("app")
 # --- ВЕРХ ФАЙЛА (рядом с импортами) ---
 def _probe(tag):
     async def _inner(update, context):
+        if not log.isEnabledFor(logging.DEBUG):
+            return
         msg = getattr(update, "effective_message", None)
-        txt = getattr(msg, "text", None)
-        log.warning("PROBE %s | has_message=%s | text=%r | entities=%s",
-                    tag, bool(msg), txt,
-                    getattr(msg, "entities", None))
+        log.debug("PROBE %s | has_message=%s | text=%r | entities=%s",
+                  tag, bool(msg), getattr(msg, "text", None),
+                  getattr(msg, "entities", None))
     return _inner
 
-# Переменные окружения 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "jslkdji&8987812kjkj9989l_lki")
-PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+# Переменные окружения — читаются один раз (app/config.py)
+settings = get_settings()
+_WEBHOOK_SECRET_B = settings.webhook_secret.encode()  # для сравнения за постоянное время
 
+# Типы апдейтов, которые бот реально обрабатывает (MessageHandler + CallbackQueryHandler).
+# Добавляете хэндлер нового типа (например, chat_member) — расширьте список.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# те же типы в виде JSON-ключей — для дешёвой проверки сырого тела вебхука
+_ALLOWED_KEYS_B = tuple(f'"{kind}"'.encode() for kind in ALLOWED_UPDATES)
 
-# ✅ Настройка уровня логирования
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.INFO  # ← вместо DEBUG
-)
+
+# ✅ Настройка уровня логирования (один раз: повторный импорт не дублирует хэндлеры)
+if not logging.getLogger().handlers:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO  # ← вместо DEBUG
+    )
 
 # ✅ Отключаем болтливые библиотеки
 for noisy in ["hpack", "httpcore", "httpx", "urllib3"]:
@@ -50,25 +70,43 @@ logging.getLogger("telegram").setLevel(logging.INFO)
 logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext").setLevel(logging.INFO)
 logging.getLogger("app.handlers").setLevel(logging.DEBUG)
-log = logging.getLogger("app")
+if settings.debug:
+    log.setLevel(logging.DEBUG)  # зонды и подробный лог вебхука
+
+
+async def _update_worker(queue: asyncio.Queue, tg_app: Application) -> None:
+    """
+    Воркер: берёт апдейт из очереди и обрабатывает его целиком (хэндлеры блокирующие).
+    Воркеров settings.concurrent_updates — столько апдейтов и обрабатывается одновременно.
+    """
+    while True:
+        update = await queue.get()
+        try:
+            await tg_app.process_update(update)
+        except Exception:
+            # ошибки хэндлеров уходят в error_handler; сюда попадает только сбой самого PTB
+            log.exception("Update %s processing failed", getattr(update, "update_id", None))
+        finally:
+            queue.task_done()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # --- старт приложения ---
-    if not TELEGRAM_BOT_TOKEN:
+    if not settings.telegram_bot_token:
         log.error("TELEGRAM_BOT_TOKEN is empty — set it in env")
         raise RuntimeError("No TELEGRAM_BOT_TOKEN")
 
     # 🔹 файл состояния на диске
-    SUPABASE_URL = os.getenv("SUPABASE_URL")
-    SUPABASE_KEY = os.getenv("SUPABASE_KEY") 
-    if not (SUPABASE_URL and SUPABASE_KEY):
+    if not (settings.supabase_url and settings.supabase_key):
         log.error("SUPABASE_URL/SUPABASE_KEY are required in env for persistence")
         raise RuntimeError("Supabase credentials are missing")
 
     # ✅ Только SupabasePersistence
-    persistence = SupabasePersistence(SUPABASE_URL, SUPABASE_KEY)
+    persistence = SupabasePersistence(
+        settings.supabase_url, settings.supabase_key,
+        update_interval=settings.persistence_update_interval,
+    )
 
     # 🔎 Fail-fast: проверяем доступ к БД/таблице прямо на старте
     try:
@@ -78,22 +116,35 @@ async def lifespan(app: FastAPI):
         log.exception("Supabase health-check FAILED: %s", e)
         raise RuntimeError(f"Supabase is not available: {e}")
     
+    # Один пул соединений к api.telegram.org: HTTP/2 мультиплексирует
+    # параллельные send/edit-запросы поверх одного TLS-соединения
+    tg_request = HTTPXRequest(
+        connection_pool_size=256,
+        http_version="2",
+        pool_timeout=5.0,
+        connect_timeout=2.0,
+        read_timeout=10.0,
+    )
+
     tg_app = (
         Application.builder()
-        .token(TELEGRAM_BOT_TOKEN)
+        .token(settings.telegram_bot_token)
+        .request(tg_request)
         .persistence(persistence)
         .build()
     )
 
     # ⬇️ Регистрируем хэндлеры PTB
-    # 0) Диагностические зонды — только логируют, ничего не блокируют
-    tg_app.add_handler(MessageHandler(filters.ALL, _probe("A:TOP"), block=False), group=-1100)
+    # 0) Диагностические зонды — только логируют, ничего не блокируют (только при DEBUG)
+    if settings.debug:
+        tg_app.add_handler(MessageHandler(filters.ALL, _probe("A:TOP"), block=False), group=-1100)
 
     # 1) Глобальный троттлер — ДО всего; команды и callback он пропускает ранним return
     tg_app.add_handler(MessageHandler(filters.ALL, global_throttle, block=False), group=-1000)
 
     # 2) Зонд прямо перед командами
-    tg_app.add_handler(MessageHandler(filters.ALL, _probe("B:BEFORE_CMDS"), block=False), group=-200)
+    if settings.debug:
+        tg_app.add_handler(MessageHandler(filters.ALL, _probe("B:BEFORE_CMDS"), block=False), group=-200)
 
     # 3) КОМАНДЫ — отдельной группой ДО любых catch-all
     tg_app.add_handler(CommandHandler("start", start), group=-100)
@@ -101,18 +152,35 @@ async def lifespan(app: FastAPI):
     tg_app.add_handler(CommandHandler("help", help_command), group=-100)
     tg_app.add_handler(CommandHandler("settings", settings_command), group=-100)
 
+    # 3a) Мини-опрос /survey — в группе команд, ДО unknown_command.
+    #     Блокирующий: survey_name останавливает дальнейшие группы, чтобы ответ
+    #     с именем не уходил ещё и в echo.
+    tg_app.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("survey", survey_start)],
+        states={ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, survey_name)]},
+        fallbacks=[CommandHandler("cancel", survey_cancel)],
+        name="survey",
+        persistent=True,
+        block=True,
+    ), group=-100)
+
     # 4) Зонд после команд
-    tg_app.add_handler(MessageHandler(filters.ALL, _probe("C:AFTER_CMDS"), block=False), group=-50)
+    if settings.debug:
+        tg_app.add_handler(MessageHandler(filters.ALL, _probe("C:AFTER_CMDS"), block=False), group=-50)
 
     # 5) CallbackQuery — после команд
-    tg_app.add_handler(CallbackQueryHandler(settings_callback), group=0)
+    tg_app.add_handler(CallbackQueryHandler(settings_callback, pattern=is_settings_callback), group=0)
 
     # 6) Остальные обработчики сообщений (НЕ команды)
-    tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo), group=0)
-    tg_app.add_handler(MessageHandler(~filters.TEXT & ~filters.COMMAND, non_text), group=0)
+    #    текст -> echo, всё остальное -> non_text (ветвление внутри route_message)
+    tg_app.add_handler(MessageHandler(~filters.COMMAND, route_message), group=0)
 
     # 7) Неизвестные команды — САМОЕ ПОСЛЕДНЕЕ
     tg_app.add_handler(MessageHandler(filters.COMMAND, unknown_command), group=-100)   
+
+    # 8) Ошибки хэндлеров: апдейты обрабатываются в фоне (webhook уже ответил 200),
+    #    поэтому исключения больше некому «увидеть», кроме error handler'а
+    tg_app.add_error_handler(error_handler)
         
     # 
     app.state.tg_app = tg_app
@@ -121,9 +189,21 @@ async def lifespan(app: FastAPI):
     # Переходим к работе приложения
 
     await tg_app.initialize()   # подготовить внутренние ресурсы PTB (сессии, луп и т.д.)
-    await tg_app.start()        # запустить фоновые задачи PTB, чтобы обрабатывать update_queue
+    await tg_app.start()        # запустить фоновые задачи PTB (job queue, запись persistence)
     log.info("PTB Application started")
 
+    # Своя ограниченная очередь + пул воркеров вместо update_queue PTB:
+    # вебхук только кладёт апдейт, обработка идёт не более чем в N воркерах.
+    # Хэндлеры блокирующие (PTB по умолчанию), поэтому process_update ждёт
+    # их завершения и воркер действительно ограничивает параллельность.
+    # Очередь переполнена — вебхук отвечает 503, Telegram доставит апдейт позже.
+    app.state.update_q = asyncio.Queue(maxsize=settings.update_queue_size)
+    app.state.workers = [
+        asyncio.create_task(_update_worker(app.state.update_q, tg_app))
+        for _ in range(settings.concurrent_updates)
+    ]
+    log.info("Started %d update workers", settings.concurrent_updates)
+
     # Меню команд в клиенте Telegram
     await tg_app.bot.set_my_commands([
         ("start", "Поздороваться и увидеть счётчик запусков"),
@@ -134,50 +214,84 @@ async def lifespan(app: FastAPI):
     ])
     log.info("Bot commands are set")
 
-    if not PUBLIC_URL:
+    if not settings.public_url:
         log.error("PUBLIC_URL is empty — set it in env")
         raise RuntimeError("No PUBLIC_URL")
 
-    webhook_url = f"{PUBLIC_URL}/webhook"
+    webhook_url = f"{settings.public_url}/webhook"
     await tg_app.bot.set_webhook(
         url=webhook_url,
-        secret_token=WEBHOOK_SECRET,      # Telegram пришлёт этот секрет в заголовке
+        secret_token=settings.webhook_secret,      # Telegram пришлёт этот секрет в заголовке
         drop_pending_updates=True,        # не тянуть «старые» апдейты
-        allowed_updates=["message", "callback_query"]
+        allowed_updates=ALLOWED_UPDATES
     )
     log.info("Webhook set to %s", webhook_url) 
 
     yield
 
     # --- остановка приложения ---
+    # Telegram уже получил 200 на апдейты из очереди и повторно их не пришлёт:
+    # сначала даём воркерам доработать очередь и текущие апдейты, потом гасим их
+    workers = getattr(app.state, "workers", [])
+    update_q = getattr(app.state, "update_q", None)
+    if workers and update_q is not None:
+        try:
+            await asyncio.wait_for(update_q.join(), timeout=settings.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.warning("Shutdown: %d updates still queued after %.0fs, dropping them",
+                        update_q.qsize(), settings.shutdown_timeout)
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
     tg_app = getattr(app.state, "tg_app", None)
     if tg_app:
         await tg_app.stop()       # остановить фоновые задачи (обработка очереди)
-        await tg_app.shutdown()   # корректно освободить ресурсы
+        await tg_app.shutdown()   # корректно освободить ресурсы (и persistence.flush())
         log.info("PTB Application stopped")
+    # пул соединений к Supabase закрываем последним — после финального flush
+    close_supabase_client()
 
-app = FastAPI(lifespan=lifespan)
+# ответы сериализуем через orjson, как и разбираем входящие апдейты
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/healthz")
 async def healthz():
-    log.debug("Health check requested")
     return {"status": "ok"}
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     # NEW: видим, что вообще до нас дошёл запрос и какие заголовки пришли
-    log.info("Webhook hit: method=%s, headers=%s", request.method, dict(request.headers))
-
-    header_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
-    if header_secret != WEBHOOK_SECRET:
-        log.warning("Webhook header secret mismatch: got=%r expected=%r", header_secret, WEBHOOK_SECRET)
+    # заголовки собираем только если debug-запись действительно будет выведена
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Webhook hit: method=%s, headers=%s",
+                  request.method,
+                  [(k, v) for k, v in request.headers.items()
+                   if k != "x-telegram-bot-api-secret-token"])  # секрет не светим
+
+    header_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+    if not hmac.compare_digest(header_secret, _WEBHOOK_SECRET_B):
+        # сам секрет в лог не пишем
+        log.warning("Webhook header secret mismatch")
         raise HTTPException(status_code=403, detail="bad header secret")
-    log.info("Webhook header OK")
 
-    data = await request.json()
+    raw = await request.body()
+    # апдейты чужих типов не разбираем вовсе: ни JSON, ни Update.de_json
+    if not any(key in raw for key in _ALLOWED_KEYS_B):
+        return {"ok": True}
+    data = orjson.loads(raw)
     update = Update.de_json(data, app.state.tg_app.bot)
-    await app.state.tg_app.process_update(update)
-    log.info("Update forwarded to PTB (ok)")
+    # Кладём апдейт в очередь и сразу отвечаем Telegram 200:
+    # обработку делают воркеры, запущенные в lifespan
+    try:
+        app.state.update_q.put_nowait(update)
+    except asyncio.QueueFull:
+        # backpressure: не копим апдейты бесконечно, Telegram доставит их повторно
+        log.warning("Update queue is full (%d), rejecting update %s",
+                    settings.update_queue_size, update.update_id)
+        raise HTTPException(status_code=503, detail="update queue is full")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Update %s queued to PTB", update.update_id)
     return {"ok": True}
 
 @app.get("/webhook-info")
@@ -192,4 +306,21 @@ async def webhook_info():
         "last_error_message": info.last_error_message,
         "max_connections": info.max_connections,
         "ip_address": info.ip_address,
-    }
\ No newline at end of file
+    }
+
+if __name__ == "__main__":
+    # Локальный/контейнерный запуск: python -m app.main
+    # Ровно ОДИН воркер: каждый процесс держит свою копию состояния SupabasePersistence
+    # (и перезаписывал бы строки других), свой троттлинг и сам вызывает set_webhook.
+    # Масштабируемся через concurrent_updates внутри процесса, а не через -w N.
+    import uvicorn
+
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=settings.port,
+        loop="auto",          # uvloop, если установлен
+        http="httptools",
+        workers=1,
+        timeout_keep_alive=30,
+    )
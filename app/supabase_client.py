@@ -0,0 +1,71 @@
+# app/supabase_client.py
+
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import List
+
+import httpx
+import orjson
+from supabase import create_client, Client, ClientOptions
+
+# созданные httpx-клиенты — чтобы закрыть их при остановке приложения
+_HTTP_CLIENTS: List[httpx.Client] = []
+
+
+class _OrjsonClient(httpx.Client):
+    """
+    httpx.Client, который кодирует тела json= через orjson, а не stdlib json.
+    Заодно понимает orjson.Fragment — уже закодированные куски JSON
+    (так SupabasePersistence передаёт сегменты состояния).
+    """
+
+    def build_request(self, method, url, *, json=None, content=None, headers=None, **kwargs):
+        if json is not None and content is None:
+            content = orjson.dumps(json, option=orjson.OPT_NON_STR_KEYS)
+            headers = httpx.Headers(headers)
+            headers["Content-Type"] = "application/json"
+            json = None
+        return super().build_request(method, url, json=json, content=content,
+                                     headers=headers, **kwargs)
+
+
+def _pooled_http_client() -> httpx.Client:
+    """
+    httpx-клиент для PostgREST: ограниченный пул с keepalive и HTTP/2,
+    чтобы не платить TLS-рукопожатием за каждый запрос к Supabase.
+    Транспорт сам повторяет неудачные попытки соединения.
+    """
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(
+            max_connections=60,
+            max_keepalive_connections=40,
+            keepalive_expiry=60,
+        ),
+    )
+    client = _OrjsonClient(
+        transport=transport,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+    )
+    _HTTP_CLIENTS.append(client)
+    return client
+
+
+@lru_cache(maxsize=1)
+def get_supabase_client(supabase_url: str, supabase_key: str) -> Client:
+    """
+    Один Supabase-клиент на процесс.
+    Повторные вызовы с теми же url/key возвращают уже созданный клиент,
+    поэтому persistence, health-check и хэндлеры делят один пул соединений.
+    """
+    options = ClientOptions(httpx_client=_pooled_http_client())
+    return create_client(supabase_url, supabase_key, options=options)
+
+
+def close_supabase_client() -> None:
+    """Закрывает пул соединений; следующий get_supabase_client() создаст новый."""
+    get_supabase_client.cache_clear()
+    while _HTTP_CLIENTS:
+        _HTTP_CLIENTS.pop().close()
@@ -2,17 +2,53 @@
 
 from __future__ import annotations
 
-import json
 import logging
 import asyncio
-from collections import defaultdict
-from typing import Any, DefaultDict, Dict, Hashable, Tuple, Optional
+import base64
+import random
+from collections import OrderedDict, defaultdict
+from typing import Any, DefaultDict, Dict, Hashable, List, Set, Tuple, Optional
 
-from supabase import create_client, Client
-from telegram.ext import BasePersistence, PersistenceInput, _utils
+import httpx
+import orjson
+import zstandard
+from postgrest.types import ReturnMethod
+from supabase import Client
+from telegram.ext import BasePersistence, PersistenceInput
+
+from app.supabase_client import get_supabase_client
 
 log = logging.getLogger("app.supabase")
 
+# Повторы запросов при сетевых сбоях: экспоненциальная пауза с джиттером
+_RETRY_ATTEMPTS = 6
+_RETRY_BASE = 0.2   # сек, пауза перед первым повтором
+_RETRY_CAP = 10.0   # сек, максимальная пауза
+
+# PostgREST отдаёт не больше max-rows строк за запрос (в Supabase по умолчанию 1000)
+_PAGE_SIZE = 1000
+# сколько строк отправляем одним upsert/delete
+_WRITE_CHUNK = 500
+
+# Все сегменты состояния; строки <prefix>:* с другими именами при загрузке игнорируем
+_SEGMENTS = ("user_data", "chat_data", "bot_data", "conversations", "callback_data")
+# Сегменты, которые храним по строке на ключ (пользователя, чат, разговор)
+_SHARDED = ("user_data", "chat_data", "conversations")
+
+# Большие `data` жмём zstd и кладём в обёртку {"__zstd__": "<base64>"}
+_ZSTD_KEY = "__zstd__"
+_ZSTD_MIN_SIZE = 4096  # байт JSON; мелкие строки сжатие только раздует
+# компрессор не потокобезопасен — пользуемся им только из event loop (_row_for)
+_ZSTD_C = zstandard.ZstdCompressor(level=3)
+_ZSTD_D = zstandard.ZstdDecompressor()
+
+
+def _unwrap(data: Any) -> Any:
+    """Разворачивает zstd-обёртку из _row_for; обычные данные возвращает как есть."""
+    if isinstance(data, dict) and len(data) == 1 and _ZSTD_KEY in data:
+        return orjson.loads(_ZSTD_D.decompress(base64.b64decode(data[_ZSTD_KEY])))
+    return data
+
 
 def _conv_key_encode(key: Tuple[Hashable, Hashable]) -> str:
     """
@@ -29,7 +65,7 @@ def _conv_key_decode(s: str) -> Tuple[Hashable, Hashable]:
         return (int(s), None)
     chat_str, thread_str = s.split(":", 1)
     chat_id = int(chat_str) if chat_str else None
-    thread_id = int(thread_str) if thread_str else None if thread_str != "" else None
+    thread_id = int(thread_str) if thread_str else None
     return (chat_id, thread_id)
 
 
@@ -37,14 +73,18 @@ class SupabasePersistence(BasePersistence):
     """
     Persistence для python-telegram-bot, сохраняющий состояние в Supabase.
 
-    В таблице `bot_state` держим 5 строк:
-      - <prefix>:user_data
-      - <prefix>:chat_data
+    В таблице `bot_state` держим строки:
+      - <prefix>:user_data:<user_id>  — по строке на пользователя
+      - <prefix>:chat_data:<chat_id>  — по строке на чат
+      - <prefix>:conversations:<name>:<chat_id>:<thread_id> — по строке на разговор
       - <prefix>:bot_data
-      - <prefix>:conversations
       - <prefix>:callback_data
 
-    Где `data` — это JSON.
+    Где `data` — это JSON. Изменение одного пользователя/чата/разговора
+    пишет одну маленькую строку, а не весь сегмент целиком.
+    Старые общие строки <prefix>:user_data, <prefix>:chat_data и
+    <prefix>:conversations читаются при загрузке, переносятся построчно и удаляются.
+    Имя ConversationHandler не должно содержать ":".
     """
 
     def __init__(
@@ -55,62 +95,115 @@ class SupabasePersistence(BasePersistence):
         prefix: str = "main",
         store_data: Optional[PersistenceInput] = None,
         flush_on_update: bool = True,
+        update_interval: float = 60,
+        flush_interval: float = 0.25,
+        max_conversations: int = 10_000,
     ) -> None:
-        super().__init__(store_data=store_data)
-        self.client: Client = create_client(supabase_url, supabase_key)
+        # update_interval — как часто PTB сам сбрасывает изменения в persistence (сек)
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.client: Client = get_supabase_client(supabase_url, supabase_key)
         self.table: str = table
         self.prefix: str = prefix
         self.flush_on_update: bool = flush_on_update
+        # окно «дребезга» (сек): изменения за это время уходят одним upsert
+        self.flush_interval: float = flush_interval
+        # сколько разговоров одного ConversationHandler держим в памяти (LRU)
+        self.max_conversations: int = max_conversations
 
         # Локальные кэши (как в DictPersistence)
         self._user_data: DefaultDict[int, Dict[str, Any]] = defaultdict(dict)
         self._chat_data: DefaultDict[int, Dict[str, Any]] = defaultdict(dict)
         self._bot_data: Dict[str, Any] = {}
-        self._conversations: Dict[str, Dict[Tuple[Hashable, Hashable], Any]] = {}
+        # по имени — OrderedDict: в конце недавно изменённые, в начале кандидаты на вытеснение
+        self._conversations: Dict[str, "OrderedDict[Tuple[Hashable, Hashable], Any]"] = {}
         self._callback_data: Dict[str, Any] = {}
 
-        # Загружаем состояние один раз при инициализации
-        self._load_all()
+        # Что изменилось с последнего flush() — пишем только это.
+        # Элемент — (сегмент, ключ): ("bot_data", None) для целого сегмента,
+        # ("user_data", user_id), ("conversations", (name, key)) для одной строки
+        self._dirty: Set[Tuple[str, Any]] = set()
+        # Что пишется прямо сейчас (уже вынуто из _dirty). При ошибке вернётся в dirty,
+        # поэтому вытеснять такие разговоры из кэша тоже нельзя
+        self._inflight: Set[Tuple[str, Any]] = set()
+        # Фоновая запись: все update_* за flush_interval сливаются в один upsert
+        self._flush_task: Optional[asyncio.Task] = None
+        # Один писатель за раз: upsert'ы не обгоняют друг друга,
+        # а flush() при остановке дожидается текущей фоновой записи
+        self._write_lock = asyncio.Lock()
+
+        # Состояние загружаем лениво при первом get_* (в потоке, не блокируя loop)
+        self._loaded: bool = False
+        self._load_lock = asyncio.Lock()
 
     # ---------- Публичные вспомогательные методы ----------
 
     async def health_check(self) -> None:
         """
         Fail-fast проверка доступности Supabase и таблицы.
-        Выполняет select + upsert тестовой записи и удаляет её.
+        Один upsert тестовой записи с returning=representation: ответ
+        с этой же строкой подтверждает и запись, и чтение за один запрос.
+        Запись не удаляем — следующий запуск её перезапишет. id вне пространства
+        <prefix>:*, поэтому в загрузку состояния (_load_all) она не попадает.
         """
-        # 1) лёгкий SELECT
+        probe_id = f"__healthcheck__:{self.prefix}"
         try:
-            _ = self.client.table(self.table).select("id").limit(1).execute()
+            res = await self._execute(
+                self.client.table(self.table).upsert(
+                    {"id": probe_id, "data": {"ok": True}},
+                    returning=ReturnMethod.representation,
+                )
+            )
         except Exception as e:
-            raise RuntimeError(f"Cannot select from table '{self.table}': {e}")
+            raise RuntimeError(f"Cannot upsert into '{self.table}': {e}")
+        if not res.data or not (res.data[0].get("data") or {}).get("ok"):
+            raise RuntimeError(f"Upsert into '{self.table}' returned no data")
 
-        # 2) пробный round-trip
-        probe_id = f"{self.prefix}:__healthcheck__"
-        try:
-            self.client.table(self.table).upsert({"id": probe_id, "data": {"ok": True}}).execute()
-            got = self.client.table(self.table).select("data").eq("id", probe_id).execute()
-            if not got.data:
-                raise RuntimeError("Upsert succeeded but select returned no data")
-        except Exception as e:
-            raise RuntimeError(f"Cannot upsert/select in '{self.table}': {e}")
-        finally:
+    # ---------- Доступ к Supabase ----------
+
+    @staticmethod
+    async def _execute(query: Any) -> Any:
+        """
+        Единая точка выполнения запросов. supabase-py синхронный,
+        поэтому .execute() уходит в пул потоков и не блокирует event loop.
+        Сетевые ошибки (обрыв, таймаут, пул занят) повторяем с backoff;
+        ошибки самого PostgREST (4xx/5xx с телом) пробрасываем сразу.
+        """
+        for attempt in range(_RETRY_ATTEMPTS):
             try:
-                self.client.table(self.table).delete().eq("id", probe_id).execute()
-            except Exception:
-                logging.getLogger("app.handlers").warning("Healthcheck cleanup failed", exc_info=True)
+                return await asyncio.to_thread(query.execute)
+            except httpx.TransportError as e:
+                if attempt == _RETRY_ATTEMPTS - 1:
+                    raise
+                delay = min(_RETRY_CAP, _RETRY_BASE * 2 ** attempt) + random.random() * 0.1
+                log.warning("Supabase request failed (%s), retry %d/%d in %.2fs",
+                            e, attempt + 1, _RETRY_ATTEMPTS - 1, delay)
+                await asyncio.sleep(delay)
 
     # ---------- Реализация обязательных методов BasePersistence ----------
 
+    async def _ensure_loaded(self) -> None:
+        """Один раз подтягивает состояние из Supabase, не блокируя event loop."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                await self._load_all()
+                self._loaded = True
+
     async def get_user_data(self) -> DefaultDict[int, Dict[str, Any]]:
+        await self._ensure_loaded()
         return self._user_data
     async def get_chat_data(self) -> DefaultDict[int, Dict[str, Any]]:
+        await self._ensure_loaded()
         return self._chat_data
     async def get_bot_data(self) -> Dict[str, Any]:
+        await self._ensure_loaded()
         return self._bot_data
     async def get_callback_data(self) -> Optional[Dict[str, Any]]:
+        await self._ensure_loaded()
         return self._callback_data
     async def get_conversations(self, name: str) -> Dict[Tuple[Hashable, Hashable], Any]:
+        await self._ensure_loaded()
         return self._conversations.get(name, {})
         
 
@@ -119,147 +212,284 @@ class SupabasePersistence(BasePersistence):
     async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
         if not self.store_data.user_data: return
         self._user_data[user_id] = data
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("user_data", user_id))
+        if self.flush_on_update: self._schedule_flush()
 
     async def update_chat_data(self, chat_id: int, data: Dict[str, Any]) -> None:
         if not self.store_data.chat_data: return
         self._chat_data[chat_id] = data
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("chat_data", chat_id))
+        if self.flush_on_update: self._schedule_flush()
 
     async def update_bot_data(self, data: Dict[str, Any]) -> None:
         if not self.store_data.bot_data: return
         self._bot_data = data
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("bot_data", None))
+        if self.flush_on_update: self._schedule_flush()
 
     async def update_callback_data(self, data: Dict[str, Any]) -> None:
         if not self.store_data.callback_data: return
         self._callback_data = data
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("callback_data", None))
+        if self.flush_on_update: self._schedule_flush()
 
     async def update_conversation(self, name: str, key: Tuple[Hashable, Hashable], new_state: Any) -> None:
-        if not self.store_data.conversations: return
-        conv = self._conversations.setdefault(name, {})
+        # в PersistenceInput нет флага conversations: PTB вызывает этот метод
+        # только для ConversationHandler(persistent=True)
+        conv = self._conversations.setdefault(name, OrderedDict())
+        # сначала dirty, потом вытеснение: только что изменённый ключ вытеснять нельзя
+        self._dirty.add(("conversations", (name, key)))
         if new_state is None: conv.pop(key, None)
-        else: conv[key] = new_state
-        if self.flush_on_update: await self.flush()
+        else:
+            conv[key] = new_state
+            conv.move_to_end(key)
+            self._evict_conversations(name, conv)
+        if self.flush_on_update: self._schedule_flush()
+
+    def _evict_conversations(self, name: str, conv: "OrderedDict[Tuple[Hashable, Hashable], Any]") -> None:
+        """
+        Выкидывает из кэша давно не менявшиеся разговоры сверх max_conversations.
+        PTB держит свою копию разговоров, а у каждого разговора уже есть своя строка
+        в таблице — кэш нужен только чтобы собрать строку при flush. Поэтому ещё
+        не записанные (dirty) и записываемые сейчас (_inflight) не трогаем:
+        если запись не удастся, при повторе строку будет не из чего собрать,
+        а отсутствие в кэше _row_for понимает как «удалить строку».
+        Вызывается только из update_conversation: к этому моменту PTB уже забрал
+        полный набор разговоров через get_conversations, поэтому после загрузки
+        кэш не урезаем — иначе PTB не восстановил бы часть разговоров.
+        """
+        excess = len(conv) - self.max_conversations
+        if excess <= 0:
+            return
+        stale = []
+        for key in conv:  # от давно не менявшихся к свежим
+            item = ("conversations", (name, key))
+            if item not in self._dirty and item not in self._inflight:
+                stale.append(key)
+                if len(stale) == excess:
+                    break
+        for key in stale:
+            del conv[key]
 
     async def drop_user_data(self, user_id: int) -> None:
         self._user_data.pop(user_id, None)
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("user_data", user_id))
+        if self.flush_on_update: self._schedule_flush()
 
     async def drop_chat_data(self, chat_id: int) -> None:
         self._chat_data.pop(chat_id, None)
-        if self.flush_on_update: await self.flush()
+        self._dirty.add(("chat_data", chat_id))
+        if self.flush_on_update: self._schedule_flush()
+
+    # --- refresh* PTB вызывает перед КАЖДЫМ хэндлером; ничего не пишем в БД ---
+    # Внешнего источника изменений нет, поэтому только синхронизируем кэш.
 
     async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
         self._user_data[user_id] = user_data
-        if self.flush_on_update: await self.flush()
 
     async def refresh_chat_data(self, chat_id: int, chat_data: Dict[str, Any]) -> None:
         self._chat_data[chat_id] = chat_data
-        if self.flush_on_update: await self.flush()
 
     async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
         self._bot_data = bot_data or {}
-        if self.flush_on_update: await self.flush()
-        
-    def _flush_sync(self) -> None:
-        rows = [
-            {"id": f"{self.prefix}:user_data", "data": self._user_data},
-            {"id": f"{self.prefix}:chat_data", "data": self._chat_data},
-            {"id": f"{self.prefix}:bot_data", "data": self._bot_data},
-            {"id": f"{self.prefix}:conversations", "data": self._conversations_encode(self._conversations)},
-            {"id": f"{self.prefix}:callback_data", "data": self._callback_data},
-        ]
-        try:
-            self.client.table(self.table).upsert(rows).execute()
-        except Exception:
-            log.exception("Supabase upsert failed in flush()")
+
+
+    def _row_id(self, segment: str, key: Any = None) -> str:
+        """id строки в таблице: целый сегмент или одна его запись."""
+        if key is None:
+            return f"{self.prefix}:{segment}"
+        if segment == "conversations":
+            name, conv_key = key
+            key = f"{name}:{_conv_key_encode(conv_key)}"
+        return f"{self.prefix}:{segment}:{key}"
+
+    def _row_for(self, segment: str, key: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Строка таблицы для сегмента (или одной его записи). `data` кодируем orjson'ом сразу,
+        в потоке loop: это снимок состояния — поток с upsert'ом уже не читает живые
+        dict'ы, которые в это время меняют хэндлеры. Fragment вставляется в тело
+        запроса как есть (см. _OrjsonClient в app/supabase_client.py).
+        None — строку нужно удалить (запись удалена, старый общий JSON перенесён).
+        """
+        if segment in _SHARDED:
+            if key is None:
+                return None
+            if segment == "conversations":
+                name, conv_key = key
+                data = self._conversations.get(name, {}).get(conv_key)
+            else:
+                # .get, а не [], чтобы defaultdict не создал пустую запись
+                data = getattr(self, f"_{segment}").get(key)
+            if data is None:
+                return None
+        else:
+            data = getattr(self, f"_{segment}")
+        encoded = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        if len(encoded) > _ZSTD_MIN_SIZE:
+            packed = base64.b64encode(_ZSTD_C.compress(encoded)).decode()
+            encoded = orjson.dumps({_ZSTD_KEY: packed})
+        return {"id": self._row_id(segment, key), "data": orjson.Fragment(encoded)}
+
+    def _schedule_flush(self) -> None:
+        """Планирует фоновую запись, если она ещё не запланирована."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._background_flush())
+
+    async def _background_flush(self) -> None:
+        # копим изменения flush_interval секунд — потом пишем их разом
+        await asyncio.sleep(self.flush_interval)
+        # пока писали, могли появиться новые изменения — дописываем их тут же;
+        # при ошибке выходим: сегменты остались dirty и уйдут со следующей записью
+        while self._dirty and await self._write_dirty():
+            pass
+
+    async def _write_dirty(self) -> bool:
+        """Пишет изменившиеся сегменты. False — если upsert не удался."""
+        async with self._write_lock:
+            # пишем только изменившиеся сегменты; нечего писать — нет и запроса
+            if not self._dirty:
+                return True
+            dirty, self._dirty = self._dirty, set()
+            self._inflight = dirty
+            try:
+                rows: List[Dict[str, Any]] = []
+                gone: List[str] = []
+                for segment, key in dirty:
+                    row = self._row_for(segment, key)
+                    if row is None:
+                        gone.append(self._row_id(segment, key))
+                    else:
+                        rows.append(row)
+                # returning=minimal (Prefer: return=minimal): PostgREST не шлёт
+                # записанные строки обратно — ответ нам всё равно не нужен
+                table = self.client.table(self.table)
+                for i in range(0, len(rows), _WRITE_CHUNK):
+                    await self._execute(
+                        table.upsert(rows[i:i + _WRITE_CHUNK], returning=ReturnMethod.minimal)
+                    )
+                for i in range(0, len(gone), _WRITE_CHUNK):
+                    await self._execute(
+                        table.delete(returning=ReturnMethod.minimal).in_("id", gone[i:i + _WRITE_CHUNK])
+                    )
+            except Exception:
+                log.exception("Supabase upsert failed in flush()")
+                # не теряем изменения: вернём их в dirty до следующего flush()
+                self._dirty |= dirty
+                return False
+            finally:
+                self._inflight = set()
+            return True
 
     async def flush(self) -> None:
-        # выполняем синхронный upsert в пуле потоков, чтобы не блокировать loop
-        await asyncio.to_thread(self._flush_sync)
+        await self._write_dirty()
 
     # ---------- Приватные методы загрузки/сериализации ----------
 
-    def _load_all(self) -> None:
-        """Ленивая загрузка всех пяти сегментов из таблицы."""
-        ids = [
-            f"{self.prefix}:user_data",
-            f"{self.prefix}:chat_data",
-            f"{self.prefix}:bot_data",
-            f"{self.prefix}:conversations",
-            f"{self.prefix}:callback_data",
-        ]
+    async def _select_like(self, pattern: str) -> List[Dict[str, Any]]:
+        """Все строки с id LIKE pattern — постранично, по _PAGE_SIZE за запрос."""
+        rows: List[Dict[str, Any]] = []
+        start = 0
+        while True:
+            resp = await self._execute(
+                self.client.table(self.table)
+                .select("id, data")
+                .like("id", pattern)
+                .order("id")
+                .range(start, start + _PAGE_SIZE - 1)
+            )
+            page = resp.data or []
+            rows.extend(page)
+            if len(page) < _PAGE_SIZE:
+                return rows
+            start += _PAGE_SIZE
+
+    async def _load_all(self) -> None:
+        """
+        Ленивая загрузка всего состояния одним проходом: все строки <prefix>:*
+        (постранично), дальше раскладываем их по сегментам по id.
+        """
         try:
-            resp = self.client.table(self.table).select("id, data").in_("id", ids).execute()
+            rows = await self._select_like(f"{self.prefix}:%")
         except Exception:
             log.exception("Supabase select failed in _load_all()")
             # оставим пустые структуры
             return
 
-        data_map: Dict[str, Any] = {row["id"]: row.get("data") for row in (resp.data or [])}
-
-        # user_data
-        ud = data_map.get(f"{self.prefix}:user_data") or {}
+        # id = <prefix>:<segment>[:<key>]; без ключа — целый сегмент (или старая общая строка)
+        data_map: Dict[str, Any] = {}
+        sharded: Dict[str, List[Tuple[str, Any]]] = {seg: [] for seg in _SHARDED}
+        n = len(self.prefix) + 1
+        for row in rows:
+            segment, _, key = row["id"][n:].partition(":")
+            if segment not in _SEGMENTS:
+                continue  # чужая строка под тем же префиксом — не наше состояние
+            if not key:
+                data_map[segment] = _unwrap(row.get("data"))
+            elif segment in sharded:
+                sharded[segment].append((key, _unwrap(row.get("data"))))
+
+        # Старые общие строки (если остались) читаем первыми: их записи
+        # переносим построчно, а сами строки удаляем; построчные записи — поверх.
+        # Кэши заполняем на месте (clear + update): объекты из __init__ остаются
+        # теми же, так что уже выданные ссылки на них не расходятся с кэшем.
+
+        # user_data: defaultdict(int->dict); заполняем генератором, без промежуточного dict
+        ud = data_map.get("user_data")
+        self._user_data.clear()
         if isinstance(ud, dict):
-            # defaultdict(int->dict)
-            self._user_data = defaultdict(dict, {int(k): v for k, v in ud.items()})
-        else:
-            self._user_data = defaultdict(dict)
+            self._user_data.update((int(k), v) for k, v in ud.items())
+            self._migrate_legacy("user_data", self._user_data)
+        self._user_data.update((int(k), v) for k, v in sharded["user_data"])
 
         # chat_data
-        cd = data_map.get(f"{self.prefix}:chat_data") or {}
+        cd = data_map.get("chat_data")
+        self._chat_data.clear()
         if isinstance(cd, dict):
-            self._chat_data = defaultdict(dict, {int(k): v for k, v in cd.items()})
-        else:
-            self._chat_data = defaultdict(dict)
+            self._chat_data.update((int(k), v) for k, v in cd.items())
+            self._migrate_legacy("chat_data", self._chat_data)
+        self._chat_data.update((int(k), v) for k, v in sharded["chat_data"])
 
         # bot_data
-        bd = data_map.get(f"{self.prefix}:bot_data") or {}
+        bd = data_map.get("bot_data")
+        self._bot_data.clear()
         if isinstance(bd, dict):
-            self._bot_data = bd
-        else:
-            self._bot_data = {}
+            self._bot_data.update(bd)
 
         # conversations
-        conv = data_map.get(f"{self.prefix}:conversations") or {}
+        conv = data_map.get("conversations")
+        self._conversations.clear()
         if isinstance(conv, dict):
-            self._conversations = self._conversations_decode(conv)
-        else:
-            self._conversations = {}
+            self._conversations.update(self._conversations_decode(conv))
+            self._migrate_legacy("conversations", [
+                (name, k) for name, mapping in self._conversations.items() for k in mapping
+            ])
+        for key, state in sharded["conversations"]:
+            name, key_str = key.split(":", 1)
+            self._conversations.setdefault(name, OrderedDict())[_conv_key_decode(key_str)] = state
 
         # callback_data
-        cb = data_map.get(f"{self.prefix}:callback_data") or {}
+        cb = data_map.get("callback_data")
+        self._callback_data.clear()
         if isinstance(cb, dict):
-            self._callback_data = cb
-        else:
-            self._callback_data = {}
+            self._callback_data.update(cb)
 
-    @staticmethod
-    def _conversations_encode(
-        conv: Dict[str, Dict[Tuple[Hashable, Hashable], Any]]
-    ) -> Dict[str, Dict[str, Any]]:
-        """
-        Превращаем ключи (chat_id, thread_id) в строки для JSON.
-        """
-        out: Dict[str, Dict[str, Any]] = {}
-        for name, mapping in conv.items():
-            encoded: Dict[str, Any] = {}
-            for key_tuple, state in mapping.items():
-                encoded[_conv_key_encode(key_tuple)] = state
-            out[name] = encoded
-        return out
+        # перенос старых строк уходит обычной фоновой записью
+        if self._dirty and self.flush_on_update:
+            self._schedule_flush()
+
+    def _migrate_legacy(self, segment: str, keys: Any) -> None:
+        """Записи из старой общей строки сегмента — в dirty построчно, саму строку — на удаление."""
+        self._dirty.update((segment, k) for k in keys)
+        self._dirty.add((segment, None))
 
     @staticmethod
     def _conversations_decode(
         data: Dict[str, Dict[str, Any]]
-    ) -> Dict[str, Dict[Tuple[Hashable, Hashable], Any]]:
-        out: Dict[str, Dict[Tuple[Hashable, Hashable], Any]] = {}
-        for name, mapping in data.items():
-            decoded: Dict[Tuple[Hashable, Hashable], Any] = {}
-            for key_str, state in (mapping or {}).items():
-                decoded[_conv_key_decode(key_str)] = state
-            out[name] = decoded
-        return out
+    ) -> Dict[str, "OrderedDict[Tuple[Hashable, Hashable], Any]"]:
+        """Ключи-строки старого общего JSON обратно в (chat_id, thread_id)."""
+        decode = _conv_key_decode
+        return {
+            name: OrderedDict((decode(key_str), state) for key_str, state in (mapping or {}).items())
+            for name, mapping in data.items()
+        }
     
\ No newline at end of file